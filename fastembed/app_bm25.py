@@ -1,173 +1,168 @@
 import os
-import logging
-from typing import List, Union
-from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import List, Optional
 
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, Field
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import ORJSONResponse
+from typing_extensions import TypedDict
 from fastembed import SparseTextEmbedding
 
-# Configure logging
-LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
-logging.basicConfig(
-    level=getattr(logging, LOG_LEVEL),
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+from embed_server.common import (
+    EmbeddingRequest,
+    ModelWorker,
+    build_app,
+    logger,
 )
-logger = logging.getLogger(__name__)
-
-# Global model instance
-model = None
-
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    """Load the model on startup and cleanup on shutdown."""
-    global model
-    model_name = os.getenv("MODEL_NAME", "Qdrant/bm25")
-    logger.info(f"Loading model: {model_name}")
-    try:
-        model = SparseTextEmbedding(model_name=model_name)
-        logger.info(f"Model {model_name} loaded successfully")
-    except Exception as e:
-        logger.error(f"Failed to load model: {e}")
-        raise
-
-    yield
-
-    # Cleanup
-    logger.info("Shutting down...")
-
-app = FastAPI(
-    title="FastEmbed BM25 Service",
-    description="API for generating BM25 sparse embeddings using FastEmbed",
-    version="1.0.0",
-    lifespan=lifespan
-)
-
-class EmbeddingRequest(BaseModel):
-    """Request model for embedding generation."""
-    texts: Union[str, List[str]] = Field(
-        ...,
-        description="Single text or list of texts to embed"
-    )
 
-class SparseValue(BaseModel):
+# Response shapes, for the OpenAPI docs only: handlers return numpy arrays
+# straight to orjson instead of validating every value through Pydantic
+class SparseValue(TypedDict):
     """Sparse vector value with index and value."""
     indices: List[int]
     values: List[float]
 
-class EmbeddingResponse(BaseModel):
+class EmbeddingResponse(TypedDict):
     """Response model for embeddings."""
     embeddings: List[SparseValue]
     model: str
     count: int
 
-@app.get("/")
-async def root():
-    """Health check endpoint."""
-    return {
-        "status": "healthy",
-        "model": os.getenv("MODEL_NAME", "Qdrant/bm25"),
-        "service": "FastEmbed BM25"
-    }
-
-@app.get("/health")
-async def health():
-    """Detailed health check endpoint."""
-    if model is None:
-        raise HTTPException(status_code=503, detail="Model not loaded")
-
-    return {
-        "status": "healthy",
-        "model": os.getenv("MODEL_NAME", "Qdrant/bm25"),
-        "model_loaded": model is not None
-    }
-
-@app.post("/embed", response_model=EmbeddingResponse)
-async def embed_text(request: EmbeddingRequest):
-    """
-    Generate BM25 sparse embeddings for the provided text(s).
-
-    Args:
-        request: EmbeddingRequest containing text(s) to embed
-
-    Returns:
-        EmbeddingResponse with sparse embeddings
-    """
-    if model is None:
-        raise HTTPException(status_code=503, detail="Model not loaded")
-
-    try:
-        # Ensure texts is a list
-        texts = request.texts if isinstance(request.texts, list) else [request.texts]
-
-        logger.info(f"Generating embeddings for {len(texts)} text(s)")
-
-        # Generate embeddings
-        embeddings_generator = model.embed(texts)
-        embeddings = list(embeddings_generator)
-
-        # Convert to response format
-        sparse_embeddings = []
-        for embedding in embeddings:
-            sparse_embeddings.append(
-                SparseValue(
-                    indices=embedding.indices.tolist(),
-                    values=embedding.values.tolist()
-                )
-            )
+class SingleEmbeddingResponse(TypedDict):
+    """Response model for a single embedding."""
+    embedding: SparseValue
+    model: str
+
+# MODEL_NAME selecting Qdrant/bm25 with the Numba-compiled scorer
+NUMBA_BM25 = "numba-bm25"
+
+class Bm25Worker(ModelWorker):
+    """BM25 sparse embedding model with its endpoints."""
+
+    service = "FastEmbed BM25"
+    default_model_name = "Qdrant/bm25"
+
+    def __init__(self, model_name: Optional[str] = None):
+        super().__init__(model_name)
+        # Numba BM25 tokenizes on the tokenizer thread and scores on the inference threads
+        self.pipelined = self.model_name == NUMBA_BM25
+
+    def create_model(self):
+        if self.model_name == NUMBA_BM25:
+            # Imported here so numba is only loaded when selected
+            from embed_server.bm25_numba import NumbaBm25
+            return NumbaBm25()
+        return SparseTextEmbedding(model_name=self.model_name)
+
+    def grpc_servicer(self):
+        from embed_server.grpc_server import Bm25Servicer
+        return Bm25Servicer(self)
+
+    def tokenize_batch(self, texts: List[str]):
+        if self.pipelined:
+            return self.model.tokenize(texts)
+        return texts
+
+    def infer_batch(self, prepared) -> list:
+        if self.pipelined:
+            return self.model.score(prepared)
+        return super().infer_batch(prepared)
 
-        logger.info(f"Successfully generated {len(sparse_embeddings)} embedding(s)")
+    def router(self) -> APIRouter:
+        router = super().router()
 
-        return EmbeddingResponse(
-            embeddings=sparse_embeddings,
-            model=os.getenv("MODEL_NAME", "Qdrant/bm25"),
-            count=len(sparse_embeddings)
-        )
+        @router.post("/embed", response_model=None, responses={200: {"model": EmbeddingResponse}})
+        async def embed_text(request: EmbeddingRequest):
+            """
+            Generate BM25 sparse embeddings for the provided text(s).
 
-    except Exception as e:
-        logger.error(f"Error generating embeddings: {e}")
-        raise HTTPException(status_code=500, detail=f"Error generating embeddings: {str(e)}")
+            Args:
+                request: EmbeddingRequest containing text(s) to embed
 
-@app.post("/embed/single")
-async def embed_single_text(request: EmbeddingRequest):
-    """
-    Generate BM25 sparse embedding for a single text.
-    Convenience endpoint that returns a single embedding object.
+            Returns:
+                EmbeddingResponse with sparse embeddings
+            """
+            self.ensure_loaded()
 
-    Args:
-        request: EmbeddingRequest containing a single text
+            try:
+                # Ensure texts is a list
+                texts = request.texts if isinstance(request.texts, list) else [request.texts]
 
-    Returns:
-        Single sparse embedding
-    """
-    if model is None:
-        raise HTTPException(status_code=503, detail="Model not loaded")
+                logger.info(f"Generating embeddings for {len(texts)} text(s)")
 
-    try:
-        # Ensure we're working with a single text
-        text = request.texts if isinstance(request.texts, str) else request.texts[0]
+                # Generate embeddings through the cache and dynamic batcher
+                embeddings = await self.embed_cached(texts)
 
-        logger.info(f"Generating embedding for single text")
+                # Convert to response format; numpy arrays are serialized natively by orjson
+                sparse_embeddings = [
+                    SparseValue(indices=embedding.indices, values=embedding.values)
+                    for embedding in embeddings
+                ]
 
-        # Generate embedding
-        embeddings_generator = model.embed([text])
-        embedding = next(embeddings_generator)
+                logger.info(f"Successfully generated {len(sparse_embeddings)} embedding(s)")
 
-        result = {
-            "embedding": {
-                "indices": embedding.indices.tolist(),
-                "values": embedding.values.tolist()
-            },
-            "model": os.getenv("MODEL_NAME", "Qdrant/bm25")
-        }
+                with self.stage_timer("serialize"):
+                    response = ORJSONResponse(EmbeddingResponse(
+                        embeddings=sparse_embeddings,
+                        model=self.model_name,
+                        count=len(sparse_embeddings)
+                    ))
+                return response
 
-        logger.info("Successfully generated single embedding")
-        return result
+            except Exception as e:
+                logger.error(f"Error generating embeddings: {e}")
+                raise HTTPException(status_code=500, detail=f"Error generating embeddings: {str(e)}")
 
-    except Exception as e:
-        logger.error(f"Error generating embedding: {e}")
-        raise HTTPException(status_code=500, detail=f"Error generating embedding: {str(e)}")
+        @router.post("/embed/single", response_model=None, responses={200: {"model": SingleEmbeddingResponse}})
+        async def embed_single_text(request: EmbeddingRequest):
+            """
+            Generate BM25 sparse embedding for a single text.
+            Convenience endpoint that returns a single embedding object.
+
+            Args:
+                request: EmbeddingRequest containing a single text
+
+            Returns:
+                Single sparse embedding
+            """
+            self.ensure_loaded()
+
+            try:
+                # Ensure we're working with a single text
+                text = request.texts if isinstance(request.texts, str) else request.texts[0]
+
+                logger.info(f"Generating embedding for single text")
+
+                # Generate embedding through the cache and dynamic batcher
+                embedding = (await self.embed_cached([text]))[0]
+
+                result = SingleEmbeddingResponse(
+                    embedding=SparseValue(indices=embedding.indices, values=embedding.values),
+                    model=self.model_name
+                )
+
+                logger.info("Successfully generated single embedding")
+                with self.stage_timer("serialize"):
+                    response = ORJSONResponse(result)
+                return response
+
+            except Exception as e:
+                logger.error(f"Error generating embedding: {e}")
+                raise HTTPException(status_code=500, detail=f"Error generating embedding: {str(e)}")
+
+        return router
+
+app = build_app(
+    title="FastEmbed BM25 Service",
+    description="API for generating BM25 sparse embeddings using FastEmbed",
+    workers={"": Bm25Worker()}
+)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Workers are separate processes, each loading its own copy of the model
+    uvicorn.run(
+        f"{Path(__file__).stem}:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+    )
\ No newline at end of file
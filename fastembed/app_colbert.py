@@ -1,170 +1,362 @@
 import os
-import logging
-from typing import List, Union
-from contextlib import asynccontextmanager
-
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, Field
+import base64
+import asyncio
+from pathlib import Path
+from typing import Annotated, List, Literal, Optional, Tuple, Union
+
+import numpy as np
+import orjson
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from typing_extensions import TypedDict
 from fastembed import LateInteractionTextEmbedding
 
-# Configure logging
-LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
-logging.basicConfig(
-    level=getattr(logging, LOG_LEVEL),
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-)
-logger = logging.getLogger(__name__)
-
-# Global model instance
-model = None
-
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    """Load the model on startup and cleanup on shutdown."""
-    global model
-    model_name = os.getenv("MODEL_NAME", "colbert-ir/colbertv2.0")
-    logger.info(f"Loading model: {model_name}")
-    try:
-        model = LateInteractionTextEmbedding(model_name=model_name)
-        logger.info(f"Model {model_name} loaded successfully")
-    except Exception as e:
-        logger.error(f"Failed to load model: {e}")
-        raise
-
-    yield
-
-    # Cleanup
-    logger.info("Shutting down...")
-
-app = FastAPI(
-    title="FastEmbed ColBERT Service",
-    description="API for generating ColBERT late interaction embeddings using FastEmbed",
-    version="1.0.0",
-    lifespan=lifespan
+from embed_server.common import (
+    EmbeddingRequest,
+    ModelWorker,
+    build_app,
+    logger,
 )
-
-class EmbeddingRequest(BaseModel):
-    """Request model for embedding generation."""
-    texts: Union[str, List[str]] = Field(
-        ...,
-        description="Single text or list of texts to embed"
-    )
-
-class MultiVectorValue(BaseModel):
+from embed_server.embedding_table import INPUTS_EMBEDS, offload_word_embeddings
+from embed_server.onnx_session import IOBindingRunner
+
+# Texts per ONNX forward pass within a batch
+INFERENCE_BATCH_SIZE = int(os.getenv("INFERENCE_BATCH_SIZE", "16"))
+
+# Set to "1" to run inference through IO binding with reusable output buffers
+ORT_IO_BINDING = os.getenv("ORT_IO_BINDING", "0") == "1"
+
+# Set to "1" to serve the word embedding table from a memory-mapped file
+# through an LRU cache of EMBEDDING_ROW_CACHE rows (0 for 10% of the vocabulary)
+EMBEDDING_TABLE_MMAP = os.getenv("EMBEDDING_TABLE_MMAP", "0") == "1"
+EMBEDDING_ROW_CACHE = int(os.getenv("EMBEDDING_ROW_CACHE", "0"))
+
+# Optional int8 quantization of the returned token vectors
+Quantize = Annotated[
+    Optional[Literal["int8"]],
+    Query(description="Quantize token vectors to int8 ({scale, shape, data}) to cut the response size ~4x")
+]
+
+# Response shapes, for the OpenAPI docs only: handlers return numpy arrays
+# straight to orjson instead of validating every value through Pydantic
+class QuantizedEmbedding(TypedDict):
+    """Int8-quantized (tokens x dim) embedding."""
+    scale: List[float]
+    shape: Tuple[int, int]
+    data: str  # base64 of the row-major int8 values
+
+# List of token embeddings, or their int8 quantization
+TokenEmbeddings = Union[List[List[float]], QuantizedEmbedding]
+
+class MultiVectorValue(TypedDict):
     """Multi-vector embedding value."""
-    embeddings: List[List[float]]  # List of token embeddings
+    embeddings: TokenEmbeddings
 
-class EmbeddingResponse(BaseModel):
+class EmbeddingResponse(TypedDict):
     """Response model for embeddings."""
     embeddings: List[MultiVectorValue]
     model: str
     count: int
 
-@app.get("/")
-async def root():
-    """Health check endpoint."""
-    return {
-        "status": "healthy",
-        "model": os.getenv("MODEL_NAME", "colbert-ir/colbertv2.0"),
-        "service": "FastEmbed ColBERT"
-    }
-
-@app.get("/health")
-async def health():
-    """Detailed health check endpoint."""
-    if model is None:
-        raise HTTPException(status_code=503, detail="Model not loaded")
-
-    return {
-        "status": "healthy",
-        "model": os.getenv("MODEL_NAME", "colbert-ir/colbertv2.0"),
-        "model_loaded": model is not None
-    }
-
-@app.post("/embed", response_model=EmbeddingResponse)
-async def embed_text(request: EmbeddingRequest):
-    """
-    Generate ColBERT late interaction embeddings for the provided text(s).
-
-    Args:
-        request: EmbeddingRequest containing text(s) to embed
+class SingleEmbeddingResponse(TypedDict):
+    """Response model for a single embedding."""
+    embedding: TokenEmbeddings
+    model: str
+    num_vectors: int
 
-    Returns:
-        EmbeddingResponse with multi-vector embeddings
-    """
-    if model is None:
-        raise HTTPException(status_code=503, detail="Model not loaded")
-
-    try:
-        # Ensure texts is a list
-        texts = request.texts if isinstance(request.texts, list) else [request.texts]
-
-        logger.info(f"Generating embeddings for {len(texts)} text(s)")
-
-        # Generate embeddings
-        embeddings_generator = model.embed(texts)
-        embeddings = list(embeddings_generator)
-
-        # Convert to response format
-        multi_vector_embeddings = []
-        for embedding in embeddings:
-            # ColBERT produces multiple vectors (one per token)
-            multi_vector_embeddings.append(
-                MultiVectorValue(
-                    embeddings=embedding.tolist()
-                )
-            )
-
-        logger.info(f"Successfully generated {len(multi_vector_embeddings)} embedding(s)")
-
-        return EmbeddingResponse(
-            embeddings=multi_vector_embeddings,
-            model=os.getenv("MODEL_NAME", "colbert-ir/colbertv2.0"),
-            count=len(multi_vector_embeddings)
-        )
-
-    except Exception as e:
-        logger.error(f"Error generating embeddings: {e}")
-        raise HTTPException(status_code=500, detail=f"Error generating embeddings: {str(e)}")
-
-@app.post("/embed/single")
-async def embed_single_text(request: EmbeddingRequest):
+def quantize_int8(embedding: np.ndarray) -> QuantizedEmbedding:
     """
-    Generate ColBERT late interaction embedding for a single text.
-    Convenience endpoint that returns a single embedding object.
+    Symmetric per-vector int8 quantization of a (tokens x dim) embedding.
 
-    Args:
-        request: EmbeddingRequest containing a single text
-
-    Returns:
-        Single multi-vector embedding
+    Token vector t is recovered as data[t] * scale[t], where data is the
+    base64-encoded row-major int8 matrix of the given shape.
     """
-    if model is None:
-        raise HTTPException(status_code=503, detail="Model not loaded")
-
-    try:
-        # Ensure we're working with a single text
-        text = request.texts if isinstance(request.texts, str) else request.texts[0]
-
-        logger.info(f"Generating embedding for single text")
-
-        # Generate embedding
-        embeddings_generator = model.embed([text])
-        embedding = next(embeddings_generator)
-
-        result = {
-            "embedding": embedding.tolist(),
-            "model": os.getenv("MODEL_NAME", "colbert-ir/colbertv2.0"),
-            "num_vectors": len(embedding)
-        }
-
-        logger.info(f"Successfully generated single embedding with {len(embedding)} vectors")
-        return result
+    scale = np.abs(embedding).max(axis=1) / 127
+    # Punctuation and padding vectors are all zeros
+    scale[scale == 0] = 1.0
+    data = np.clip(np.round(embedding / scale[:, None]), -128, 127).astype(np.int8)
+    return QuantizedEmbedding(
+        scale=scale.astype(np.float32),
+        shape=data.shape,
+        data=base64.b64encode(data.tobytes()).decode()
+    )
 
-    except Exception as e:
-        logger.error(f"Error generating embedding: {e}")
-        raise HTTPException(status_code=500, detail=f"Error generating embedding: {str(e)}")
+def encode_embedding(embedding: np.ndarray, quantize: Optional[str]):
+    """Return the embedding as sent on the wire: raw floats or int8-quantized."""
+    return quantize_int8(embedding) if quantize == "int8" else embedding
+
+class ColbertWorker(ModelWorker):
+    """ColBERT late interaction model with its endpoints."""
+
+    service = "FastEmbed ColBERT"
+    default_model_name = "colbert-ir/colbertv2.0"
+    pipelined = True
+
+    def __init__(self, model_name: Optional[str] = None):
+        super().__init__(model_name)
+        # IOBindingRunner used by the inference stage when ORT_IO_BINDING is set
+        self.runner = None
+        # Punctuation token ids whose vectors FastEmbed zeroes in documents
+        self.skip_ids = None
+        # EmbeddingTable feeding inputs_embeds when EMBEDDING_TABLE_MMAP is set
+        self.embedding_table = None
+
+    def create_model(self):
+        return LateInteractionTextEmbedding(model_name=self.model_name)
+
+    def load(self):
+        super().load()
+        if EMBEDDING_TABLE_MMAP:
+            # After quantization, whose probe embeds through FastEmbed with input_ids
+            self.embedding_table = offload_word_embeddings(self.model, EMBEDDING_ROW_CACHE or None)
+        self.skip_ids = np.array(sorted(self.model.model.skip_list), dtype=np.int64)
+        if ORT_IO_BINDING:
+            session = self.model.model.model
+            if IOBindingRunner.supports(session):
+                max_seq_len = (self.model.model.tokenizer.truncation or {}).get("max_length", 512)
+                self.runner = IOBindingRunner(session, INFERENCE_BATCH_SIZE, max_seq_len)
+                logger.info("Inference runs through IO binding")
+            else:
+                logger.warning("Model output shape does not support IO binding, using session.run")
+
+    def grpc_servicer(self):
+        from embed_server.grpc_server import ColbertServicer
+        return ColbertServicer(self)
+
+    def tokenize_batch(self, texts: List[str]) -> tuple:
+        """
+        Tokenizer stage: turn a batch of texts into ONNX inputs.
+
+        Texts are sorted longest first and split into forward passes of
+        INFERENCE_BATCH_SIZE texts, so each pass pads to a similar length
+        instead of to the longest text of the whole batch.
+
+        Together with infer_batch this is FastEmbed's Colbert.onnx_embed split
+        in two, so the next batch can be tokenized while the previous one is
+        in inference. It relies on FastEmbed internals (model.model is the
+        Colbert instance, model.model.model its onnxruntime session), which is
+        why the fastembed version is pinned.
+
+        Returns:
+            (order, passes) where order[k] is the input index of the k-th text
+            after sorting, and passes holds an (onnx_input, skip, lengths)
+            tuple per forward pass, skip marking the punctuation and padding
+            tokens whose vectors are zeroed
+        """
+        colbert = self.model.model
+        input_names = {node.name for node in colbert.model.get_inputs()}
+        order = sorted(range(len(texts)), key=lambda i: -len(texts[i]))
+
+        passes = []
+        for start in range(0, len(order), INFERENCE_BATCH_SIZE):
+            encoded = colbert.tokenize([texts[i] for i in order[start:start + INFERENCE_BATCH_SIZE]])
+            input_ids = np.array([e.ids for e in encoded], dtype=np.int64)
+            attention_mask = np.array([e.attention_mask for e in encoded], dtype=np.int64)
+
+            onnx_input = {"input_ids": input_ids}
+            if "attention_mask" in input_names:
+                onnx_input["attention_mask"] = attention_mask
+            if "token_type_ids" in input_names:
+                onnx_input["token_type_ids"] = np.zeros_like(input_ids)
+            onnx_input = colbert._preprocess_onnx_input(onnx_input)
+            if self.embedding_table is not None:
+                onnx_input[INPUTS_EMBEDS] = self.embedding_table.lookup(input_ids)
+                if "input_ids" not in input_names:
+                    del onnx_input["input_ids"]
+
+            skip = np.isin(input_ids, self.skip_ids) | (input_ids == colbert.pad_token_id)
+            passes.append((onnx_input, skip, attention_mask.sum(axis=1)))
+        return order, passes
+
+    def infer_batch(self, prepared: tuple) -> list:
+        """
+        Inference stage: run the forward passes of a tokenized batch.
+
+        Does what FastEmbed's Colbert._post_process_onnx_output does (zero
+        the punctuation vectors, L2-normalize the rest) with numpy instead
+        of a Python loop over every token, and writes each text's vectors
+        straight into its own exactly sized array, leaving out the padding.
+        Results are returned in input order.
+        """
+        colbert = self.model.model
+        order, passes = prepared
+
+        results = [None] * len(order)
+        position = 0
+        for onnx_input, skip, lengths in passes:
+            if self.runner is not None:
+                # Backed by a per-thread buffer, only read below
+                model_output = self.runner.run(onnx_input)
+            else:
+                model_output = colbert.model.run(colbert.ONNX_OUTPUT_NAMES, onnx_input)[0]
+            for i, length in enumerate(lengths):
+                vectors = model_output[i, :length]
+                norm = np.linalg.norm(vectors, axis=1, keepdims=True)
+                np.maximum(norm, 1e-12, out=norm)
+                embedding = np.empty(vectors.shape, dtype=np.float32)
+                np.divide(vectors, norm, out=embedding)
+                embedding[skip[i, :length]] = 0
+                results[order[position]] = embedding
+                position += 1
+        return results
+
+    def router(self) -> APIRouter:
+        router = super().router()
+
+        @router.post("/embed", response_model=None, responses={200: {"model": EmbeddingResponse}})
+        async def embed_text(
+            request: EmbeddingRequest,
+            quantize: Quantize = None
+        ):
+            """
+            Generate ColBERT late interaction embeddings for the provided text(s).
+
+            Args:
+                request: EmbeddingRequest containing text(s) to embed
+                quantize: Optional "int8" to return int8-quantized token vectors
+
+            Returns:
+                EmbeddingResponse with multi-vector embeddings
+            """
+            self.ensure_loaded()
+
+            try:
+                # Ensure texts is a list
+                texts = request.texts if isinstance(request.texts, list) else [request.texts]
+
+                logger.info(f"Generating embeddings for {len(texts)} text(s)")
+
+                # Generate embeddings through the cache and dynamic batcher
+                embeddings = await self.embed_cached(texts)
+
+                with self.stage_timer("serialize"):
+                    # Convert to response format; ColBERT produces multiple vectors (one per token),
+                    # each document's (tokens x dim) array is serialized natively by orjson
+                    multi_vector_embeddings = [
+                        MultiVectorValue(embeddings=encode_embedding(embedding, quantize)) for embedding in embeddings
+                    ]
+                    response = ORJSONResponse(EmbeddingResponse(
+                        embeddings=multi_vector_embeddings,
+                        model=self.model_name,
+                        count=len(multi_vector_embeddings)
+                    ))
+
+                logger.info(f"Successfully generated {len(multi_vector_embeddings)} embedding(s)")
+                return response
+
+            except Exception as e:
+                logger.error(f"Error generating embeddings: {e}")
+                raise HTTPException(status_code=500, detail=f"Error generating embeddings: {str(e)}")
+
+        @router.post("/embed/single", response_model=None, responses={200: {"model": SingleEmbeddingResponse}})
+        async def embed_single_text(
+            request: EmbeddingRequest,
+            quantize: Quantize = None
+        ):
+            """
+            Generate ColBERT late interaction embedding for a single text.
+            Convenience endpoint that returns a single embedding object.
+
+            Args:
+                request: EmbeddingRequest containing a single text
+                quantize: Optional "int8" to return int8-quantized token vectors
+
+            Returns:
+                Single multi-vector embedding
+            """
+            self.ensure_loaded()
+
+            try:
+                # Ensure we're working with a single text
+                text = request.texts if isinstance(request.texts, str) else request.texts[0]
+
+                logger.info(f"Generating embedding for single text")
+
+                # Generate embedding through the cache and dynamic batcher
+                embedding = (await self.embed_cached([text]))[0]
+
+                with self.stage_timer("serialize"):
+                    response = ORJSONResponse(SingleEmbeddingResponse(
+                        embedding=encode_embedding(embedding, quantize),
+                        model=self.model_name,
+                        num_vectors=len(embedding)
+                    ))
+
+                logger.info(f"Successfully generated single embedding with {len(embedding)} vectors")
+                return response
+
+            except Exception as e:
+                logger.error(f"Error generating embedding: {e}")
+                raise HTTPException(status_code=500, detail=f"Error generating embedding: {str(e)}")
+
+        @router.post("/embed/stream")
+        async def embed_text_stream(
+            request: EmbeddingRequest,
+            quantize: Quantize = None
+        ):
+            """
+            Generate ColBERT late interaction embeddings, streamed as NDJSON.
+
+            Each line is a JSON object {"index": i, "embedding": [[...], ...]}. It is
+            sent as soon as embedding i is ready, in input order, so clients can
+            start parsing before the whole batch is done.
+
+            Args:
+                request: EmbeddingRequest containing text(s) to embed
+                quantize: Optional "int8" to return int8-quantized token vectors
+
+            Returns:
+                StreamingResponse with one embedding per line
+            """
+            self.ensure_loaded()
+
+            # Ensure texts is a list
+            texts = request.texts if isinstance(request.texts, list) else [request.texts]
+
+            logger.info(f"Streaming embeddings for {len(texts)} text(s)")
+
+            # Queue every text up front so they are still batched together
+            tasks = [asyncio.ensure_future(self.embed_cached([text])) for text in texts]
+
+            async def generate():
+                try:
+                    for i, task in enumerate(tasks):
+                        try:
+                            embedding = (await task)[0]
+                        except Exception as e:
+                            logger.error(f"Error generating embeddings: {e}")
+                            yield orjson.dumps({"index": i, "error": f"Error generating embeddings: {str(e)}"}) + b"\n"
+                            return
+                        with self.stage_timer("serialize"):
+                            line = orjson.dumps(
+                                {"index": i, "embedding": encode_embedding(embedding, quantize)},
+                                option=orjson.OPT_SERIALIZE_NUMPY
+                            ) + b"\n"
+                        yield line
+                    logger.info(f"Successfully streamed {len(tasks)} embedding(s)")
+                finally:
+                    # Client went away or a text failed: drop the remaining work
+                    for task in tasks:
+                        if task.done() and not task.cancelled():
+                            task.exception()  # Already reported; silence "never retrieved"
+                        task.cancel()
+
+            return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+        return router
+
+app = build_app(
+    title="FastEmbed ColBERT Service",
+    description="API for generating ColBERT late interaction embeddings using FastEmbed",
+    workers={"": ColbertWorker()}
+)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Workers are separate processes, each loading its own copy of the model
+    uvicorn.run(
+        f"{Path(__file__).stem}:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+    )
\ No newline at end of file
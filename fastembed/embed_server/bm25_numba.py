@@ -0,0 +1,128 @@
+import logging
+import threading
+from typing import Dict, List, Tuple
+
+import numba
+import numpy as np
+from fastembed import SparseTextEmbedding
+from fastembed.sparse.sparse_embedding_base import SparseEmbedding
+
+logger = logging.getLogger(__name__)
+
+# Raw tokens whose ids are memoized; past this the memo is started over
+TOKEN_MEMO_SIZE = 1_000_000
+
+@numba.njit(parallel=True, cache=True)
+def _score_batch(token_ids, offsets, k1, b, avgdl):
+    """
+    BM25 term-frequency weights of a batch of tokenized documents.
+
+    Document d holds token_ids[offsets[d]:offsets[d + 1]]. The result is in
+    the same CSR layout: document d's unique ids and weights are
+    indices/values[out_offsets[d]:out_offsets[d + 1]], ids in ascending
+    order. IDF is not applied, Qdrant does that at query time (modifier="idf").
+    """
+    n = offsets.shape[0] - 1
+    ids = token_ids.copy()
+
+    # Sort every document's ids so equal ids are adjacent, and count them
+    counts = np.zeros(n, dtype=np.int64)
+    for d in numba.prange(n):
+        start, end = offsets[d], offsets[d + 1]
+        ids[start:end] = np.sort(ids[start:end])
+        unique = 0
+        for t in range(start, end):
+            if t == start or ids[t] != ids[t - 1]:
+                unique += 1
+        counts[d] = unique
+
+    out_offsets = np.zeros(n + 1, dtype=np.int64)
+    out_offsets[1:] = np.cumsum(counts)
+    indices = np.empty(out_offsets[n], dtype=np.int64)
+    values = np.empty(out_offsets[n], dtype=np.float64)
+
+    for d in numba.prange(n):
+        start, end = offsets[d], offsets[d + 1]
+        length_norm = k1 * (1 - b + b * (end - start) / avgdl)
+        position = out_offsets[d] - 1
+        for t in range(start, end):
+            if t == start or ids[t] != ids[t - 1]:
+                position += 1
+                indices[position] = ids[t]
+                values[position] = 0.0
+            values[position] += 1.0
+        for p in range(out_offsets[d], out_offsets[d + 1]):
+            tf = values[p]
+            values[p] = tf * (k1 + 1) / (tf + length_norm)
+
+    return out_offsets, indices, values
+
+class NumbaBm25:
+    """
+    Qdrant/bm25 sparse embeddings with the scoring compiled by Numba.
+
+    Tokenization, stopwords, stemming and token ids are FastEmbed's own
+    (its Bm25 model is loaded for them), so the embeddings match
+    Qdrant/bm25. Token ids are memoized per raw token, and the term counting
+    and weighting run in _score_batch instead of a Python loop per document.
+    Entries within an embedding are ordered by token id.
+    """
+
+    def __init__(self, model_name: str = "Qdrant/bm25"):
+        # Keeps the FastEmbed model layout (model.model) for session lookups;
+        # Bm25 has no ONNX session
+        self.model = SparseTextEmbedding(model_name=model_name).model
+        self.token_ids: Dict[str, int] = {}
+        # The default workqueue threading layer does not allow concurrent launches
+        self.lock = threading.Lock()
+
+        # Compile (or load the cached compilation) before the first request
+        self.embed(["warm up"])
+
+    def token_id(self, token: str) -> int:
+        """Token id of a raw token, or -1 for punctuation, stopwords and empty stems."""
+        bm25 = self.model
+        token_id = self.token_ids.get(token)
+        if token_id is None:
+            token_id = -1
+            if token not in bm25.punctuation and token not in bm25.stopwords:
+                stemmed = bm25.stemmer.stemWord(token)
+                if stemmed:
+                    token_id = bm25.compute_token_id(stemmed)
+            if len(self.token_ids) >= TOKEN_MEMO_SIZE:
+                self.token_ids = {}
+            self.token_ids[token] = token_id
+        return token_id
+
+    def tokenize(self, documents: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Token ids of a batch of documents in CSR layout.
+
+        Returns:
+            (token_ids, offsets) where document d holds
+            token_ids[offsets[d]:offsets[d + 1]]
+        """
+        token_ids = []
+        offsets = [0]
+        for document in documents:
+            for token in self.model.tokenizer.tokenize(document):
+                token_id = self.token_id(token)
+                if token_id >= 0:
+                    token_ids.append(token_id)
+            offsets.append(len(token_ids))
+        return np.array(token_ids, dtype=np.int64), np.array(offsets, dtype=np.int64)
+
+    def score(self, tokenized: Tuple[np.ndarray, np.ndarray]) -> List[SparseEmbedding]:
+        """BM25 weights of tokenized documents, one SparseEmbedding per document."""
+        bm25 = self.model
+        token_ids, offsets = tokenized
+        with self.lock:
+            out_offsets, indices, values = _score_batch(token_ids, offsets, bm25.k, bm25.b, bm25.avg_len)
+        return [
+            SparseEmbedding(indices=indices[start:end], values=values[start:end])
+            for start, end in zip(out_offsets[:-1], out_offsets[1:])
+        ]
+
+    def embed(self, documents: List[str]) -> List[SparseEmbedding]:
+        """Embed a batch of documents."""
+        return self.score(self.tokenize(documents))
@@ -0,0 +1,442 @@
+import os
+import asyncio
+import logging
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from hashlib import blake2b
+from typing import Dict, List, Optional, Union
+
+from fastapi import APIRouter, FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
+from prometheus_fastapi_instrumentator import Instrumentator
+from pydantic import BaseModel, Field, field_validator
+
+from .metrics import BATCH_SIZE, LATENCY, QUEUE_DEPTH
+from .onnx_session import configure_session, quantize_model
+
+# Configure logging
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+logging.basicConfig(
+    level=getattr(logging, LOG_LEVEL),
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Dynamic batching configuration
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "32"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "5"))
+
+# Number of batches in inference concurrently, across all models of the app
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", os.cpu_count() or 1))
+
+# ONNX Runtime intra-op threads per forward pass (0 for one per core).
+# Up to EMBED_THREADS passes run at once in every uvicorn worker, so keep
+# WEB_CONCURRENCY x EMBED_THREADS x ORT_THREADS close to the number of cores.
+ORT_THREADS = int(os.getenv("ORT_THREADS", "1"))
+
+# Set to "int8" to run ONNX models with dynamically quantized weights
+QUANTIZE = os.getenv("QUANTIZE", "")
+
+# Maximum number of embeddings kept in each model's LRU cache
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "10000"))
+
+# Port of the gRPC frontend (disabled when unset)
+GRPC_PORT = int(os.getenv("GRPC_PORT")) if os.getenv("GRPC_PORT") else None
+
+# Request limits, answered with 413 so a single oversized request cannot
+# monopolize the batcher or the worker's memory. MAX_BATCH bounds the texts
+# of one request; the batcher still splits them into BATCH_MAX_SIZE batches.
+MAX_BATCH = int(os.getenv("MAX_BATCH", "64"))
+MAX_CHARS_PER_TEXT = int(os.getenv("MAX_CHARS_PER_TEXT", "20000"))
+MAX_BODY_BYTES = int(os.getenv("MAX_BODY_BYTES", str(8 * 1024 * 1024)))
+
+def limit_error(texts: List[str]) -> Optional[str]:
+    """Why texts exceed MAX_BATCH or MAX_CHARS_PER_TEXT, or None if they are within limits."""
+    if len(texts) > MAX_BATCH:
+        return f"Too many texts: {len(texts)} (max {MAX_BATCH})"
+    for i, text in enumerate(texts):
+        if len(text) > MAX_CHARS_PER_TEXT:
+            return f"Text {i} is too long: {len(text)} characters (max {MAX_CHARS_PER_TEXT})"
+    return None
+
+class EmbeddingRequest(BaseModel):
+    """Request model for embedding generation."""
+    texts: Union[str, List[str]] = Field(
+        ...,
+        description=f"Single text or list of texts to embed (at most {MAX_BATCH}, "
+                    f"each at most {MAX_CHARS_PER_TEXT} characters)"
+    )
+
+    @field_validator("texts")
+    @classmethod
+    def check_limits(cls, texts: Union[str, List[str]]) -> Union[str, List[str]]:
+        """Reject oversized requests with 413 rather than a 422 validation error."""
+        error = limit_error(texts if isinstance(texts, list) else [texts])
+        if error is not None:
+            raise HTTPException(status_code=413, detail=error)
+        return texts
+
+class BodySizeLimitMiddleware:
+    """
+    ASGI middleware answering 413 to request bodies over max_body_size bytes.
+
+    Bodies announcing a larger Content-Length are rejected before they are
+    read; chunked bodies are cut off as soon as they grow past the limit.
+    """
+
+    def __init__(self, app, max_body_size: int):
+        self.app = app
+        self.max_body_size = max_body_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        detail = f"Request body too large (max {self.max_body_size} bytes)"
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_body_size:
+            response = ORJSONResponse({"detail": detail}, status_code=413)
+            return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body_size:
+                    # Raised while FastAPI reads the body, which passes HTTPException through
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+def cache_key(text: str) -> bytes:
+    """Fixed-size cache key for an arbitrarily long text."""
+    return blake2b(text.encode(), digest_size=16).digest()
+
+class ModelWorker:
+    """
+    One embedding model behind a dynamic batcher and an LRU cache.
+
+    Subclasses set the service name and default model, implement
+    create_model() and add their embedding endpoints in router(). Batches
+    are embedded by infer_batch() on the shared executor; models that set
+    pipelined also get a tokenize_batch() stage, run on the tokenizer
+    thread while earlier batches are still in inference.
+    """
+
+    service = "FastEmbed"
+    default_model_name = None
+    pipelined = False
+
+    def __init__(self, model_name: Optional[str] = None):
+        self.model_name = model_name or os.getenv("MODEL_NAME", self.default_model_name)
+        self.model = None
+
+        # Queue of (text, future) pairs waiting to be embedded by the batcher
+        self.batch_queue = None
+        self.batcher = None
+
+        # LRU cache of embeddings keyed by a digest of the text
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def create_model(self):
+        """Instantiate the FastEmbed model."""
+        raise NotImplementedError
+
+    def load(self):
+        """Load the model and apply the configured ONNX Runtime tuning."""
+        logger.info(f"Loading model: {self.model_name}")
+        try:
+            self.model = self.create_model()
+            logger.info(f"Model {self.model_name} loaded successfully")
+            configure_session(self.model, ORT_THREADS)
+            if QUANTIZE == "int8":
+                quantize_model(self.model)
+        except Exception as e:
+            logger.error(f"Failed to load model: {e}")
+            raise
+
+    def grpc_servicer(self):
+        """gRPC servicer exposing this model, or None if it has no gRPC service."""
+        return None
+
+    def tokenize_batch(self, texts: List[str]):
+        """Tokenizer stage of pipelined models; the result is passed to infer_batch."""
+        return texts
+
+    def infer_batch(self, texts: List[str]) -> list:
+        """Embed a batch of texts with a single model.embed call."""
+        return list(self.model.embed(texts))
+
+    def start(self, executor: ThreadPoolExecutor, tokenizer_executor: ThreadPoolExecutor,
+              slots: asyncio.Semaphore):
+        """Start the dynamic batcher on the running event loop."""
+        self.batch_queue = asyncio.Queue()
+        QUEUE_DEPTH.labels(self.model_name).set_function(self.batch_queue.qsize)
+        self.batcher = asyncio.create_task(self.batch_worker(executor, tokenizer_executor, slots))
+
+    async def stop(self):
+        """Stop the dynamic batcher."""
+        self.batcher.cancel()
+        try:
+            await self.batcher
+        except asyncio.CancelledError:
+            pass
+
+    async def batch_worker(self, executor: ThreadPoolExecutor, tokenizer_executor: ThreadPoolExecutor,
+                           slots: asyncio.Semaphore):
+        """Coalesce queued texts into batches and hand them to the inference threads."""
+        loop = asyncio.get_running_loop()
+        while True:
+            # One in-flight batch per executor thread; while all threads are busy,
+            # new texts keep accumulating in the queue and form larger batches.
+            # Only take a slot once there is work, so an idle model never holds
+            # one the other models of the app could use.
+            batch = [await self.batch_queue.get()]
+            await slots.acquire()
+            deadline = loop.time() + BATCH_MAX_WAIT_MS / 1000
+            while len(batch) < BATCH_MAX_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.batch_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            texts = [text for text, _ in batch]
+            logger.debug(f"Running {self.model_name} batch of {len(texts)} text(s)")
+            BATCH_SIZE.labels(self.model_name).observe(len(texts))
+            try:
+                prepared = texts
+                if self.pipelined:
+                    # Tokenize this batch while earlier batches are still in inference
+                    prepared = await loop.run_in_executor(
+                        tokenizer_executor, self.run_stage, "tokenize", self.tokenize_batch, texts
+                    )
+                done = loop.run_in_executor(executor, self.run_stage, "inference", self.infer_batch, prepared)
+            except Exception as e:
+                done = loop.create_future()
+                done.set_exception(e)
+            done.add_done_callback(functools.partial(self.scatter_results, batch, slots))
+
+    def stage_timer(self, stage: str):
+        """Context manager recording the latency of a stage (tokenize, inference, serialize)."""
+        return LATENCY.labels(self.model_name, stage).time()
+
+    def run_stage(self, stage: str, fn, *args):
+        """Run one stage of a batch, recording its latency."""
+        with self.stage_timer(stage):
+            return fn(*args)
+
+    @staticmethod
+    def scatter_results(batch: list, slots: asyncio.Semaphore, done: asyncio.Future):
+        """Hand the embeddings of a finished batch back to the waiting requests."""
+        slots.release()
+        for i, (_, future) in enumerate(batch):
+            # The requester may have gone away (e.g. client disconnect)
+            if future.done():
+                continue
+            if done.cancelled():
+                future.cancel()
+            elif done.exception() is not None:
+                future.set_exception(done.exception())
+            else:
+                future.set_result(done.result()[i])
+
+    async def submit(self, texts: List[str]) -> list:
+        """
+        Queue texts for the dynamic batcher and wait for their embeddings.
+
+        Args:
+            texts: Texts to embed
+
+        Returns:
+            Embeddings in the same order as texts
+        """
+        loop = asyncio.get_running_loop()
+        futures = []
+        for text in texts:
+            future = loop.create_future()
+            self.batch_queue.put_nowait((text, future))
+            futures.append(future)
+        return await asyncio.gather(*futures)
+
+    async def embed_cached(self, texts: List[str]) -> list:
+        """
+        Embed texts, serving repeated texts from the LRU cache.
+
+        Only cache misses are sent to the dynamic batcher.
+
+        Args:
+            texts: Texts to embed
+
+        Returns:
+            Embeddings in the same order as texts
+        """
+        keys = [cache_key(text) for text in texts]
+        results = [self.cache.get(key) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+
+        for key, result in zip(keys, results):
+            if result is not None:
+                self.cache.move_to_end(key)
+        self.cache_hits += len(texts) - len(missing)
+        self.cache_misses += len(missing)
+
+        if missing:
+            embeddings = await self.submit([texts[i] for i in missing])
+            for i, embedding in zip(missing, embeddings):
+                results[i] = embedding
+                self.cache[keys[i]] = embedding
+                self.cache.move_to_end(keys[i])
+            while len(self.cache) > EMBED_CACHE_SIZE:
+                self.cache.popitem(last=False)
+
+        return results
+
+    def ensure_loaded(self):
+        """Raise 503 until the model is loaded."""
+        if self.model is None:
+            raise HTTPException(status_code=503, detail="Model not loaded")
+
+    def router(self) -> APIRouter:
+        """Health and cache endpoints; subclasses add their embedding endpoints."""
+        router = APIRouter()
+
+        @router.get("/")
+        async def root():
+            """Health check endpoint."""
+            return {
+                "status": "healthy",
+                "model": self.model_name,
+                "service": self.service
+            }
+
+        @router.get("/health")
+        async def health():
+            """Detailed health check endpoint."""
+            self.ensure_loaded()
+
+            return {
+                "status": "healthy",
+                "model": self.model_name,
+                "model_loaded": self.model is not None,
+                # Prometheus metrics: embed_batch_size, embed_queue_depth and
+                # embed_latency_seconds{stage="tokenize|inference|serialize"}
+                "metrics": "/metrics"
+            }
+
+        @router.get("/cache/stats")
+        async def cache_stats():
+            """Embedding cache statistics."""
+            lookups = self.cache_hits + self.cache_misses
+            return {
+                "size": len(self.cache),
+                "max_size": EMBED_CACHE_SIZE,
+                "hits": self.cache_hits,
+                "misses": self.cache_misses,
+                "hit_ratio": self.cache_hits / lookups if lookups else 0.0
+            }
+
+        return router
+
+def build_app(title: str, description: str, workers: Dict[str, ModelWorker]) -> FastAPI:
+    """
+    Create the FastAPI app serving one or more models.
+
+    All models share one inference thread pool, one tokenizer thread and the
+    in-flight batch limit; each keeps its own batcher and cache.
+
+    Args:
+        title: OpenAPI title
+        description: OpenAPI description
+        workers: Route prefix ("" for a single-model app) to ModelWorker
+
+    Returns:
+        The FastAPI app
+    """
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        """Load the models on startup and cleanup on shutdown."""
+        for worker in workers.values():
+            # Already loaded when gunicorn preloaded the app (see preload_models)
+            if worker.model is None:
+                worker.load()
+
+        app.state.executor = ThreadPoolExecutor(max_workers=EMBED_THREADS, thread_name_prefix="embed")
+        app.state.tokenizer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tokenize")
+        app.state.slots = asyncio.Semaphore(EMBED_THREADS)
+        for worker in workers.values():
+            worker.start(app.state.executor, app.state.tokenizer_executor, app.state.slots)
+        logger.info(
+            f"Dynamic batching enabled (max size {BATCH_MAX_SIZE}, max wait {BATCH_MAX_WAIT_MS} ms, "
+            f"{EMBED_THREADS} thread(s))"
+        )
+        logger.info(
+            f"Request limits: {MAX_BATCH} text(s), {MAX_CHARS_PER_TEXT} characters per text, "
+            f"{MAX_BODY_BYTES} body bytes"
+        )
+
+        grpc_server = None
+        if GRPC_PORT:
+            # Imported here so grpcio and the generated stubs are only needed when enabled
+            from .grpc_server import start_grpc_server
+            grpc_server = await start_grpc_server(workers.values(), GRPC_PORT)
+
+        yield
+
+        # Cleanup
+        logger.info("Shutting down...")
+        if grpc_server is not None:
+            await grpc_server.stop(grace=5)
+        for worker in workers.values():
+            await worker.stop()
+        app.state.tokenizer_executor.shutdown(wait=True, cancel_futures=True)
+        app.state.executor.shutdown(wait=True, cancel_futures=True)
+
+    app = FastAPI(
+        title=title,
+        description=description,
+        version="1.0.0",
+        lifespan=lifespan
+    )
+    app.state.workers = workers
+    app.add_middleware(BodySizeLimitMiddleware, max_body_size=MAX_BODY_BYTES)
+    for prefix, worker in workers.items():
+        app.include_router(worker.router(), prefix=prefix)
+    Instrumentator().instrument(app).expose(app, endpoint="/metrics", include_in_schema=False)
+    return app
+
+
+def preload_models(app: FastAPI) -> bool:
+    """
+    Load the app's models in the current process, ahead of forking workers.
+
+    Forked workers then share the weights' pages copy-on-write instead of
+    each loading its own copy. ONNX Runtime thread pools do not survive a
+    fork, so this only happens with ORT_THREADS=1, where sessions run on the
+    calling thread; otherwise every worker loads its models in lifespan.
+
+    Args:
+        app: App created by build_app
+
+    Returns:
+        True if the models were loaded
+    """
+    if ORT_THREADS != 1:
+        logger.warning(f"Not preloading models: ORT_THREADS={ORT_THREADS} is not fork-safe, set it to 1")
+        return False
+
+    logger.info(f"Preloading models before forking workers (pid {os.getpid()})")
+    for worker in app.state.workers.values():
+        worker.load()
+    return True
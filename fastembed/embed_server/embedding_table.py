@@ -0,0 +1,132 @@
+import os
+import logging
+import functools
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import onnx
+import onnxruntime as ort
+from onnx import helper, numpy_helper
+
+from .onnx_session import file_digest, find_session
+
+logger = logging.getLogger(__name__)
+
+# Graph input replacing the word embedding lookup
+INPUTS_EMBEDS = "inputs_embeds"
+
+class EmbeddingTable:
+    """
+    Word embedding table read from a memory-mapped .npy file.
+
+    Rows are looked up once per distinct token id of a batch and kept in an
+    LRU cache; everything else stays on disk (or in the shared page cache)
+    instead of in every session's weights.
+    """
+
+    def __init__(self, path: Path, cache_rows: Optional[int] = None):
+        self.table = np.load(path, mmap_mode="r")
+        vocab_size = self.table.shape[0]
+        self.cache_rows = cache_rows or max(1, vocab_size // 10)
+        # functools.lru_cache is thread-safe, the tokenizer and inference threads may share it
+        self.row = functools.lru_cache(maxsize=self.cache_rows)(self.read_row)
+
+    def read_row(self, token_id: int) -> np.ndarray:
+        """Copy one row out of the memory map."""
+        return np.array(self.table[token_id])
+
+    def lookup(self, input_ids: np.ndarray) -> np.ndarray:
+        """
+        Embed a (batch x sequence) array of token ids.
+
+        Returns:
+            float32 array of shape (batch, sequence, hidden)
+        """
+        unique, inverse = np.unique(input_ids, return_inverse=True)
+        rows = np.stack([self.row(int(token_id)) for token_id in unique])
+        return rows[inverse.reshape(input_ids.shape)]
+
+def find_word_embeddings(graph: onnx.GraphProto) -> Optional[onnx.NodeProto]:
+    """The Gather node looking up input_ids in a 2-D initializer, if any."""
+    initializers = {init.name: init for init in graph.initializer}
+    for node in graph.node:
+        if node.op_type != "Gather" or len(node.input) != 2 or node.input[1] != "input_ids":
+            continue
+        weight = initializers.get(node.input[0])
+        if weight is not None and len(weight.dims) == 2:
+            return node
+    return None
+
+def offload_word_embeddings(model, cache_rows: Optional[int] = None) -> Optional[EmbeddingTable]:
+    """
+    Move a FastEmbed model's word embedding table out of its ONNX graph.
+
+    The Gather on input_ids is removed and its output becomes a new graph
+    input, inputs_embeds, fed from the returned EmbeddingTable. The table is
+    saved as .npy and the reduced graph as .onnx next to the original model,
+    keyed by the original's content hash, so this is done once per model
+    version; input_ids stays an input only if other nodes still use it.
+
+    Args:
+        model: LateInteractionTextEmbedding (or other FastEmbed ONNX model) instance
+        cache_rows: Rows kept in the LRU cache (10% of the vocabulary by default)
+
+    Returns:
+        The table to embed input_ids with, or None if the graph has no
+        recognizable word embedding lookup
+    """
+    session = find_session(model)
+    if session is None:
+        return None
+
+    source = Path(session._model_path)
+    stem = f"{source.stem}.{file_digest(source)}"
+    table_path = source.with_name(f"{stem}.word_embeddings.npy")
+    graph_path = source.with_name(f"{stem}.no_word_embeddings.onnx")
+
+    if not (table_path.exists() and graph_path.exists()):
+        proto = onnx.load(str(source))
+        graph = proto.graph
+        gather = find_word_embeddings(graph)
+        if gather is None:
+            logger.warning("No word embedding Gather on input_ids found, keeping the table in the model")
+            return None
+
+        weight = next(init for init in graph.initializer if init.name == gather.input[0])
+        table = numpy_helper.to_array(weight)
+        logger.info(f"Moving {gather.input[0]} {table.shape} out of {source.name}")
+
+        graph.node.remove(gather)
+        graph.initializer.remove(weight)
+        for node in graph.node:
+            for i, name in enumerate(node.input):
+                if name == gather.output[0]:
+                    node.input[i] = INPUTS_EMBEDS
+        graph.input.append(helper.make_tensor_value_info(
+            INPUTS_EMBEDS, helper.np_dtype_to_tensor_dtype(table.dtype), ["batch", "sequence", table.shape[1]]
+        ))
+        if not any("input_ids" in node.input for node in graph.node):
+            graph.input.remove(next(i for i in graph.input if i.name == "input_ids"))
+
+        # Write under per-process names first so concurrent workers never
+        # load a half-written file
+        partial = table_path.with_name(f"{table_path.name}.{os.getpid()}.tmp")
+        with open(partial, "wb") as f:
+            np.save(f, table)
+        os.replace(partial, table_path)
+        partial = graph_path.with_name(f"{graph_path.name}.{os.getpid()}.tmp")
+        onnx.save(proto, str(partial))
+        os.replace(partial, graph_path)
+
+    model.model.model = ort.InferenceSession(
+        str(graph_path),
+        sess_options=session.get_session_options(),
+        providers=session.get_providers()
+    )
+    embedding_table = EmbeddingTable(table_path, cache_rows)
+    logger.info(
+        f"Word embeddings {embedding_table.table.shape} memory-mapped from {table_path.name}, "
+        f"LRU cache of {embedding_table.cache_rows} rows"
+    )
+    return embedding_table
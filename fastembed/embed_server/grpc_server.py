@@ -0,0 +1,110 @@
+import logging
+from typing import Iterable
+
+import grpc
+
+from embed_server import embed_pb2, embed_pb2_grpc
+
+from .common import MAX_BODY_BYTES, limit_error
+
+logger = logging.getLogger(__name__)
+
+# Long-lived client channels: ping idle connections so load balancers and
+# NATs keep them open, and accept the clients' own keep-alive pings
+SERVER_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+    ("grpc.http2.min_ping_interval_without_data_ms", 10000),
+    # ColBERT responses for a full batch are several MB
+    ("grpc.max_send_message_length", 64 * 1024 * 1024),
+    # Same bound as the HTTP request body; larger messages fail with RESOURCE_EXHAUSTED
+    ("grpc.max_receive_message_length", MAX_BODY_BYTES),
+]
+
+async def embed(worker, request: embed_pb2.EmbedRequest, context: grpc.aio.ServicerContext) -> list:
+    """Embed the request's texts through the worker's cache and dynamic batcher."""
+    if worker.model is None:
+        await context.abort(grpc.StatusCode.UNAVAILABLE, "Model not loaded")
+
+    texts = list(request.texts)
+    error = limit_error(texts)
+    if error is not None:
+        await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, error)
+
+    logger.info(f"Generating embeddings for {len(texts)} text(s) (gRPC)")
+    try:
+        return await worker.embed_cached(texts)
+    except Exception as e:
+        logger.error(f"Error generating embeddings: {e}")
+        await context.abort(grpc.StatusCode.INTERNAL, f"Error generating embeddings: {str(e)}")
+
+class Bm25Servicer(embed_pb2_grpc.Bm25Servicer):
+    """embed.Bm25 service backed by a BM25 worker."""
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    def add_to_server(self, server: grpc.aio.Server):
+        embed_pb2_grpc.add_Bm25Servicer_to_server(self, server)
+
+    async def Embed(self, request, context):
+        embeddings = await embed(self.worker, request, context)
+        with self.worker.stage_timer("serialize"):
+            return embed_pb2.SparseEmbedResponse(
+                embeddings=[
+                    embed_pb2.SparseEmbed(indices=embedding.indices.tolist(), values=embedding.values.tolist())
+                    for embedding in embeddings
+                ],
+                model=self.worker.model_name
+            )
+
+class ColbertServicer(embed_pb2_grpc.ColbertServicer):
+    """embed.Colbert service backed by a ColBERT worker."""
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    def add_to_server(self, server: grpc.aio.Server):
+        embed_pb2_grpc.add_ColbertServicer_to_server(self, server)
+
+    async def Embed(self, request, context):
+        embeddings = await embed(self.worker, request, context)
+        with self.worker.stage_timer("serialize"):
+            return embed_pb2.ColbertEmbedResponse(
+                embeddings=[
+                    embed_pb2.ColbertEmbed(
+                        num_tokens=embedding.shape[0],
+                        dim=embedding.shape[1],
+                        data=embedding.astype("<f4", copy=False).tobytes()
+                    )
+                    for embedding in embeddings
+                ],
+                model=self.worker.model_name
+            )
+
+async def start_grpc_server(workers: Iterable, port: int) -> grpc.aio.Server:
+    """
+    Serve the workers' gRPC services on the running event loop.
+
+    Requests share the workers' caches and dynamic batchers with the HTTP
+    endpoints. Every uvicorn worker process binds the same port
+    (SO_REUSEPORT), and the kernel spreads connections across them.
+
+    Args:
+        workers: ModelWorker instances; those without a gRPC service are skipped
+        port: Port to listen on
+
+    Returns:
+        The started server
+    """
+    server = grpc.aio.server(options=SERVER_OPTIONS)
+    for worker in workers:
+        servicer = worker.grpc_servicer()
+        if servicer is not None:
+            servicer.add_to_server(server)
+    server.add_insecure_port(f"[::]:{port}")
+    await server.start()
+    logger.info(f"gRPC server listening on port {port}")
+    return server
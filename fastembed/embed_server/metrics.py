@@ -0,0 +1,25 @@
+from prometheus_client import Gauge, Histogram
+
+# Custom metrics next to the HTTP metrics of prometheus-fastapi-instrumentator.
+# Each uvicorn worker process keeps its own registry, so a scrape of /metrics
+# reports the worker that happened to serve it.
+
+BATCH_SIZE = Histogram(
+    "embed_batch_size",
+    "Number of texts per batch formed by the dynamic batcher",
+    ["model"],
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128)
+)
+
+QUEUE_DEPTH = Gauge(
+    "embed_queue_depth",
+    "Texts waiting for the dynamic batcher",
+    ["model"]
+)
+
+LATENCY = Histogram(
+    "embed_latency_seconds",
+    "Time spent per batch (tokenize, inference) or per response (serialize)",
+    ["model", "stage"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
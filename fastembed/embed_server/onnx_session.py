@@ -0,0 +1,238 @@
+import os
+import logging
+import threading
+from hashlib import blake2b
+from pathlib import Path
+from typing import List, Optional, Set
+
+import numpy as np
+import onnxruntime as ort
+
+logger = logging.getLogger(__name__)
+
+# Texts embedded with both the original and the quantized session to
+# report how far the quantized model drifts
+PROBE_TEXTS = [
+    "Qdrant is a vector database for similarity search.",
+    "Late interaction models keep one embedding per token."
+]
+
+# x86 instruction set extensions used by ONNX Runtime's MLAS kernels, as
+# named in /proc/cpuinfo; the *vnni and amx flags enable the int8 dot-product
+# kernels that make QUANTIZE=int8 pay off
+CPU_FEATURES = ["avx2", "avx512f", "avx_vnni", "avx512_vnni", "amx_int8"]
+
+def cpu_flags() -> Set[str]:
+    """Instruction set flags of the first CPU in /proc/cpuinfo (empty where unavailable)."""
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    return set(line.split(":", 1)[1].split())
+    except OSError:
+        pass
+    return set()
+
+def cpu_providers() -> List:
+    """
+    Execution providers for rebuilt sessions: the CPU provider, explicitly.
+
+    MLAS picks the widest kernels the CPU supports (AVX2, AVX-512, VNNI, AMX)
+    at runtime; this only makes the choice explicit and logs it.
+    """
+    available = ort.get_available_providers()
+    if "CPUExecutionProvider" not in available:
+        raise RuntimeError(f"CPUExecutionProvider is not available. Available providers: {available}")
+
+    flags = cpu_flags()
+    features = [feature for feature in CPU_FEATURES if feature in flags]
+    int8_kernels = "VNNI" if any("vnni" in f or "amx" in f for f in features) else "generic"
+    logger.info(
+        f"ONNX Runtime {ort.__version__} providers available: {', '.join(available)}; using CPUExecutionProvider "
+        f"(CPU features: {', '.join(features) or 'unknown'}; int8 kernels: {int8_kernels})"
+    )
+    return ["CPUExecutionProvider"]
+
+def find_session(model) -> Optional[ort.InferenceSession]:
+    """
+    Return the onnxruntime session behind a FastEmbed model.
+
+    Args:
+        model: SparseTextEmbedding or LateInteractionTextEmbedding instance
+
+    Returns:
+        The session, or None for models that do not run ONNX (e.g. Qdrant/bm25)
+    """
+    session = getattr(model.model, "model", None)
+    return session if isinstance(session, ort.InferenceSession) else None
+
+def file_digest(path: Path) -> str:
+    """Content hash of a (possibly large) model file."""
+    digest = blake2b(digest_size=8)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def flatten(embedding) -> dict:
+    """Map a dense or sparse embedding to {position: value} for comparison."""
+    if hasattr(embedding, "as_dict"):
+        return embedding.as_dict()
+    return dict(enumerate(np.asarray(embedding).ravel()))
+
+def similarity(a, b) -> float:
+    """Cosine similarity of two embeddings of the same kind."""
+    a, b = flatten(a), flatten(b)
+    dot = sum(value * b.get(key, 0.0) for key, value in a.items())
+    norm = np.sqrt(sum(v * v for v in a.values()) * sum(v * v for v in b.values()))
+    return float(dot / norm) if norm else 1.0
+
+def session_options(threads: int) -> ort.SessionOptions:
+    """
+    Session options for one inference thread pool per session.
+
+    Batches from several request threads run concurrently, so each forward
+    pass gets a fixed number of intra-op threads and no inter-op pool
+    (sequential execution) rather than every session spawning one thread per
+    core.
+
+    Args:
+        threads: Intra-op threads; 0 leaves the choice to ONNX Runtime (one per core)
+    """
+    so = ort.SessionOptions()
+    so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    so.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    so.intra_op_num_threads = threads
+    so.inter_op_num_threads = 1
+    # Reuse freed activation buffers across runs instead of going back to malloc
+    so.enable_cpu_mem_arena = True
+    return so
+
+def configure_session(model, threads: int) -> bool:
+    """
+    Rebuild a FastEmbed model's session with session_options(threads).
+
+    FastEmbed only exposes a single thread count that it applies to both the
+    intra-op and the inter-op pool, so the session is recreated from the
+    same model file, on the CPU execution provider.
+
+    Args:
+        model: SparseTextEmbedding or LateInteractionTextEmbedding instance
+        threads: Intra-op threads; 0 leaves the choice to ONNX Runtime
+
+    Returns:
+        True if the model now runs the reconfigured session
+    """
+    session = find_session(model)
+    if session is None:
+        return False
+
+    model.model.model = ort.InferenceSession(
+        session._model_path,
+        sess_options=session_options(threads),
+        providers=cpu_providers()
+    )
+    logger.info(f"ONNX Runtime session: {threads or 'default'} intra-op thread(s), sequential execution")
+    return True
+
+def quantize_model(model) -> bool:
+    """
+    Switch a FastEmbed model to int8 (QInt8) dynamically quantized weights.
+
+    The quantized copy is written next to the original model file, keyed by
+    the original's content hash, so it is only produced once per model
+    version and shared by all workers.
+
+    Args:
+        model: SparseTextEmbedding or LateInteractionTextEmbedding instance
+
+    Returns:
+        True if the model now runs the quantized session
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    session = find_session(model)
+    if session is None:
+        logger.info("Model does not run an ONNX session, skipping int8 quantization")
+        return False
+
+    source = Path(session._model_path)
+    target = source.with_name(f"{source.stem}.{file_digest(source)}.int8.onnx")
+    if not target.exists():
+        logger.info(f"Quantizing {source} to int8")
+        # Write under a per-process name first so concurrent workers never
+        # load a half-written file
+        partial = target.with_name(f"{target.name}.{os.getpid()}.tmp")
+        quantize_dynamic(str(source), str(partial), weight_type=QuantType.QInt8)
+        os.replace(partial, target)
+
+    reference = list(model.embed(PROBE_TEXTS))
+    model.model.model = ort.InferenceSession(
+        str(target),
+        sess_options=session.get_session_options(),
+        providers=session.get_providers()
+    )
+    quantized = list(model.embed(PROBE_TEXTS))
+
+    score = min(similarity(a, b) for a, b in zip(reference, quantized))
+    logger.info(f"Loaded int8 model {target.name} (probe cosine similarity vs fp32: {score:.4f})")
+    return True
+
+class IOBindingRunner:
+    """
+    Run a session through IO binding into reusable output buffers.
+
+    Inputs are bound directly from the caller's numpy arrays (no copy), and
+    the output is written into a buffer owned by the calling thread, so
+    ONNX Runtime does not allocate a fresh output tensor for every forward
+    pass. Buffers hold max_batch x max_seq_len token positions up front and
+    grow if a pass is larger.
+
+    The returned array is overwritten by the next run on the same thread;
+    callers must copy whatever they keep.
+    """
+
+    def __init__(self, session: ort.InferenceSession, max_batch: int, max_seq_len: int):
+        self.session = session
+        self.output = session.get_outputs()[0]
+        self.positions = max_batch * max_seq_len
+        self.local = threading.local()
+
+    @staticmethod
+    def supports(session: ort.InferenceSession) -> bool:
+        """Whether the output shape is (batch, sequence, <fixed dims>) as for token embeddings."""
+        shape = session.get_outputs()[0].shape
+        return len(shape) == 3 and all(isinstance(dim, int) for dim in shape[2:])
+
+    def output_buffer(self, batch: int, seq_len: int) -> np.ndarray:
+        """This thread's output buffer, viewed as (batch, seq_len, *dims)."""
+        shape = (batch, seq_len, *self.output.shape[2:])
+        size = int(np.prod(shape))
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is None or buffer.size < size:
+            per_position = size // (batch * seq_len) if size else 1
+            buffer = np.empty(max(size, self.positions * per_position), dtype=np.float32)
+            self.local.buffer = buffer
+        return buffer[:size].reshape(shape)
+
+    def run(self, onnx_input: dict) -> np.ndarray:
+        """
+        Run one forward pass.
+
+        Args:
+            onnx_input: Input name to numpy array, as for InferenceSession.run
+
+        Returns:
+            The first model output, backed by this thread's reusable buffer
+        """
+        binding = self.session.io_binding()
+        for name, array in onnx_input.items():
+            binding.bind_cpu_input(name, np.ascontiguousarray(array))
+
+        # (batch, sequence) of the first input, input_ids or inputs_embeds
+        output = self.output_buffer(*next(iter(onnx_input.values())).shape[:2])
+        binding.bind_output(
+            self.output.name, "cpu", 0, output.dtype, output.shape, output.ctypes.data
+        )
+        self.session.run_with_iobinding(binding)
+        return output
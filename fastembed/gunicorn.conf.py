@@ -0,0 +1,41 @@
+import os
+import sys
+import logging
+
+# gunicorn runs the FastAPI app on uvicorn workers:
+#   gunicorn -c gunicorn.conf.py app:app
+# With PRELOAD_MODEL=1 (default) the models are loaded once in the master
+# process and shared copy-on-write by all forked workers.
+
+bind = "0.0.0.0:8000"
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+
+# Same setting as uvicorn's --timeout-keep-alive
+keepalive = int(os.getenv("UVICORN_TIMEOUT_KEEP_ALIVE", "5"))
+
+preload_app = os.getenv("PRELOAD_MODEL", "1") == "1"
+
+def when_ready(server):
+    """Load the models in the master, after the app is imported and before workers fork."""
+    if server.cfg.preload_app:
+        from embed_server.common import preload_models
+        preload_models(server.app.wsgi())
+
+def worker_exit(server, worker):
+    """
+    End preloaded workers without interpreter teardown.
+
+    ONNX Runtime starts a native thread when imported; in a worker forked
+    from the master that thread does not exist, and ONNX Runtime's exit-time
+    destructors abort or hang trying to join it.
+    """
+    # Also called in the master for workers that are already gone
+    if not server.cfg.preload_app or worker.pid != os.getpid():
+        return
+    exc = sys.exc_info()[1]
+    code = exc.code if isinstance(exc, SystemExit) else 0
+    logging.shutdown()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code if isinstance(code, int) else 1)
\ No newline at end of file
@@ -0,0 +1,36 @@
+import os
+from pathlib import Path
+
+from app_bm25 import Bm25Worker
+from app_colbert import ColbertWorker
+from embed_server.common import build_app
+
+# Both models in one process, sharing the inference threads:
+# BM25 under /bm25, ColBERT under /colbert
+bm25 = Bm25Worker(os.getenv("BM25_MODEL_NAME"))
+colbert = ColbertWorker(os.getenv("COLBERT_MODEL_NAME"))
+
+app = build_app(
+    title="FastEmbed Service",
+    description="API for generating BM25 sparse and ColBERT late interaction embeddings using FastEmbed",
+    workers={"/bm25": bm25, "/colbert": colbert}
+)
+
+@app.get("/")
+async def root():
+    """Health check endpoint."""
+    return {
+        "status": "healthy",
+        "models": {"bm25": bm25.model_name, "colbert": colbert.model_name},
+        "service": "FastEmbed"
+    }
+
+if __name__ == "__main__":
+    import uvicorn
+    # Workers are separate processes, each loading its own copy of both models
+    uvicorn.run(
+        f"{Path(__file__).stem}:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+    )
\ No newline at end of file